@@ -14,18 +14,41 @@ OUTPUT (processed, Parquet datasets partitioned by order_year/order_month):
 
 Requires:
 - pandas + pyarrow available in Lambda (layer or container).
+- orjson is optional; it is used for parsing the input when installed, with stdlib json as the
+  fallback for inputs orjson rejects (NaN literals, a UTF-8 BOM).
 """
 
+import gc
 import json
 import os
-import tempfile
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 import boto3
+import numpy as np
 import pandas as pd
-
-s3 = boto3.client("s3")
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+from botocore.config import Config
+
+try:
+    # orjson parses faster and with a smaller peak footprint; fall back to stdlib json if absent
+    import orjson as _json
+except ImportError:
+    _json = json
+
+# Module-scope clients/pools are reused across warm invocations of the same container.
+# Adaptive retries back off client-side on S3 503 SlowDown responses.
+s3 = boto3.client("s3", config=Config(retries={"max_attempts": 10, "mode": "adaptive"}))
+# fact_orders and fact_order_items are written side by side
+_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Copy-on-write (the default from pandas 3) makes the intermediate column selections below lazy views
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 PROCESSED_PREFIX = os.environ.get("PROCESSED_PREFIX", "processed/store_sales").rstrip("/")
 PROCESSED_BUCKET_ENV = os.environ.get("PROCESSED_BUCKET")  # optional
@@ -34,6 +57,32 @@ PROCESSED_BUCKET_ENV = os.environ.get("PROCESSED_BUCKET")  # optional
 # if you're using Hive-style partition folders like order_year=2025/order_month=1/
 PARTITION_COLS = ["order_year", "order_month"]
 
+# write_dataset moves these columns out of the file schema and into the folder path.
+# int16/int8 hold any realistic year/month and keep the partition keys small in memory.
+PARTITIONING = ds.partitioning(pa.schema(list(zip(PARTITION_COLS, (pa.int16(), pa.int8())))), flavor="hive")
+
+# Rows converted from pandas to Arrow at a time while streaming into the parquet writers
+ARROW_BATCH_ROWS = 64_000
+
+# Item fields coerced to numbers while they are still plain Python values
+ITEM_NUMERIC_COLS = ("quantity", "unit_price")
+
+# Built once at import; dictionary encoding is already pyarrow's default
+PARQUET_WRITE_OPTIONS = ds.ParquetFileFormat().make_write_options(compression="snappy")
+
+
+@lru_cache(maxsize=None)
+def _s3fs_for_bucket(bucket: str) -> pafs.S3FileSystem:
+    """
+    pyarrow S3 filesystem pinned to the bucket's own region, cached per bucket so warm
+    invocations reuse it. Unlike boto3, pyarrow does not follow S3 region redirects, so a
+    PROCESSED_BUCKET outside the Lambda's region would fail with a filesystem on AWS_REGION.
+    """
+    return pafs.S3FileSystem(
+        region=pafs.resolve_s3_region(bucket),
+        retry_strategy=pafs.AwsStandardS3RetryStrategy(max_attempts=10),
+    )
+
 
 def _parse_s3_event(event: dict) -> tuple[str, str]:
     record = event["Records"][0]
@@ -50,41 +99,117 @@ def _safe_to_datetime(series: pd.Series) -> pd.Series:
     - epoch in milliseconds: 1735735513000
     Returns UTC-aware datetime64[ns, UTC].
     """
-    s = series.copy()
-
-    # Work in string space so mixed object types don't break detection
-    s_str = s.astype("string")
+    numeric_input = pd.api.types.is_numeric_dtype(series)
+    if numeric_input:
+        # nullable Int64 keeps 19-digit ns epochs exact through the where() splits below
+        num = series.astype("Int64") if pd.api.types.is_integer_dtype(series) else series
+        is_num = num.notna()
+    else:
+        # digit-only strings are epochs
+        s_str = series.astype("string")
+        is_num = s_str.str.fullmatch(r"\d+").fillna(False)
+
+    dt_num = None
+    if is_num.any():
+        if not numeric_input:
+            # to_numeric on StringDtype returns nullable Int64, so the values stay exact
+            num = pd.to_numeric(s_str.where(is_num), errors="coerce")
+
+        # ms if < 1e15, ns if >= 1e15 (2025 ns ~ 1e18)
+        is_ms = num < 1e15
+        dt_ms = pd.to_datetime(num.where(is_ms), unit="ms", errors="coerce", utc=True)
+        dt_ns = pd.to_datetime(num.where(~is_ms), unit="ns", errors="coerce", utc=True)
+        dt_num = dt_ms.fillna(dt_ns)
+        # nothing left for the string parser
+        if numeric_input or is_num.all():
+            return dt_num
+    elif numeric_input:
+        # all-null numeric column
+        return pd.to_datetime(num, unit="ms", errors="coerce", utc=True)
+
+    # parse non-numeric values as ISO8601 in one vectorized call,
+    # falling back to per-element inference only for values that did not match
+    s_other = series.where(~is_num)
+    dt_str = pd.to_datetime(s_other, errors="coerce", utc=True, format="ISO8601")
+    retry = dt_str.isna() & s_other.notna()
+    if retry.any():
+        dt_str = dt_str.fillna(pd.to_datetime(s_other.where(retry), errors="coerce", utc=True, format="mixed"))
 
-    # numeric-only values (digits)
-    is_num = s_str.str.fullmatch(r"\d+").fillna(False)
+    # combine
+    return dt_str if dt_num is None else dt_str.fillna(dt_num)
 
-    # parse numeric candidates to integers
-    num = pd.to_numeric(s_str.where(is_num), errors="coerce")
 
-    # ms if < 1e15, ns if >= 1e15 (2025 ns ~ 1e18)
-    dt_ms = pd.to_datetime(num.where(num < 1e15), unit="ms", errors="coerce", utc=True)
-    dt_ns = pd.to_datetime(num.where(num >= 1e15), unit="ns", errors="coerce", utc=True)
-    dt_num = dt_ms.fillna(dt_ns)
+def _flatten_records(records: pd.Series, prefix: str) -> pd.DataFrame:
+    """
+    Flattens a column of dicts (customer, payment) into prefixed columns.
+    Keys are collected once in first-seen order, then each column is built with a
+    single list comprehension; non-dict values (e.g. missing objects) become nulls.
+    Nested objects fall back to json_normalize so they still become dotted columns
+    (customer_addr.city) rather than struct columns.
+    """
+    dicts = [r if isinstance(r, dict) else {} for r in records]
+    if any(isinstance(v, dict) for d in dicts for v in d.values()):
+        flat = pd.json_normalize(dicts).add_prefix(prefix)
+        flat.index = records.index
+        return flat
 
-    # parse non-numeric values as ISO/general strings
-    dt_str = pd.to_datetime(s_str.where(~is_num), errors="coerce", utc=True)
+    keys = dict.fromkeys(k for d in dicts for k in d)
+    # copy=False keeps one 1-D block per column
+    return pd.DataFrame({f"{prefix}{k}": [d.get(k) for d in dicts] for k in keys}, index=records.index, copy=False)
 
-    # combine
-    return dt_str.fillna(dt_num)
 
+def _as_numeric(values: list) -> np.ndarray:
+    """
+    Converts a list of raw JSON values to a numeric array.
+    Clean ints/floats map straight to int64/float64; anything else (None, strings,
+    nested lists) falls back to pd.to_numeric(errors="coerce").
+    """
+    try:
+        arr = np.asarray(values)
+    except ValueError:  # ragged nested lists
+        arr = None
+    if arr is not None and arr.ndim == 1 and arr.dtype.kind in "iuf":
+        return arr
+    return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy()
 
 
-def _write_parquet_and_upload(df: pd.DataFrame, bucket: str, key: str) -> None:
+def _write_partitioned_dataset(df: pd.DataFrame, filesystem: pafs.FileSystem, base_dir: str, run_id: str) -> None:
     """
-    Writes df to a local parquet file in /tmp then uploads it to s3://bucket/key
+    Writes df as a Hive-partitioned parquet dataset under base_dir (bucket/prefix).
+    One file per order_year/order_month partition (split every 1M rows), named
+    part-<run_id>-<i>.parquet.
     """
     if df is None or df.empty:
         return
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_path = os.path.join(tmpdir, "data.parquet")
-        df.to_parquet(local_path, index=False, compression="snappy")  # requires pyarrow
-        s3.upload_file(local_path, bucket, key)
+    # Streamed in ARROW_BATCH_ROWS slices; only a few batches are held in Arrow memory at once
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    batches = (
+        pa.RecordBatch.from_pandas(df.iloc[start : start + ARROW_BATCH_ROWS], schema=schema, preserve_index=False)
+        for start in range(0, len(df), ARROW_BATCH_ROWS)
+    )
+
+    ds.write_dataset(
+        batches,
+        schema=schema,
+        base_dir=base_dir,
+        filesystem=filesystem,
+        format="parquet",
+        partitioning=PARTITIONING,
+        file_options=PARQUET_WRITE_OPTIONS,
+        basename_template=f"part-{run_id}-{{i}}.parquet",
+        # one pass over the table; rows are streamed into per-partition writers, compressed on
+        # multiple cores, and small partitions are buffered into row groups large enough to compress well
+        use_threads=True,
+        max_open_files=32,
+        max_rows_per_file=1_000_000,
+        min_rows_per_group=50_000,
+        max_rows_per_group=500_000,
+        # keep files written by earlier runs into the same partitions
+        existing_data_behavior="overwrite_or_ignore",
+        # S3 has no real directories; skip the bucket check and per-partition directory markers
+        create_dir=False,
+    )
 
 
 def lambda_handler(event, context):
@@ -94,17 +219,28 @@ def lambda_handler(event, context):
     # --- Read JSON array from S3 ---
     obj = s3.get_object(Bucket=in_bucket, Key=in_key)
     raw_bytes = obj["Body"].read()
+    del obj
 
+    # pyarrow.json.read_json would parse straight into Arrow, but it only reads newline-delimited
+    # records; the raw files are a single (pretty-printed) JSON array, so they are decoded here
     try:
-        orders = json.loads(raw_bytes)
+        try:
+            orders = _json.loads(raw_bytes)
+        except json.JSONDecodeError:  # orjson.JSONDecodeError subclasses this too
+            if _json is json:
+                raise
+            # orjson rejects NaN/Infinity literals and a UTF-8 BOM, which stdlib json accepts
+            orders = json.loads(raw_bytes)
     except json.JSONDecodeError as e:
         raise RuntimeError(f"Input is not valid JSON array: s3://{in_bucket}/{in_key}") from e
+    del raw_bytes
 
     if not isinstance(orders, list) or len(orders) == 0:
         return {"status": "ok", "message": "No orders found", "input": f"s3://{in_bucket}/{in_key}"}
 
     # --- Normalize orders into DataFrame (top-level) ---
     df_orders_raw = pd.DataFrame(orders)
+    del orders
 
     # Required fields check (light)
     if "order_id" not in df_orders_raw.columns or "order_timestamp" not in df_orders_raw.columns:
@@ -114,30 +250,33 @@ def lambda_handler(event, context):
     df_orders_raw["order_timestamp"] = _safe_to_datetime(df_orders_raw["order_timestamp"])
     df_orders_raw = df_orders_raw.dropna(subset=["order_timestamp"])
 
-    df_orders_raw["order_date"] = df_orders_raw["order_timestamp"].dt.date.astype(str)  # YYYY-MM-DD
-    df_orders_raw["order_year"] = df_orders_raw["order_timestamp"].dt.year.astype("int64")
-    df_orders_raw["order_month"] = df_orders_raw["order_timestamp"].dt.month.astype("int64")
+    # .values is UTC datetime64; day precision formats as YYYY-MM-DD
+    df_orders_raw["order_date"] = df_orders_raw["order_timestamp"].values.astype("datetime64[D]").astype(str)
+    # datetime64[M] is months since 1970-01
+    months = df_orders_raw["order_timestamp"].values.astype("datetime64[M]").astype(np.int64)
+    df_orders_raw["order_year"] = (months // 12 + 1970).astype(np.int16)
+    df_orders_raw["order_month"] = (months % 12 + 1).astype(np.int8)
 
     # --- Flatten nested objects: customer.*, payment.* ---
     customer_df = (
-        pd.json_normalize(df_orders_raw["customer"]).add_prefix("customer_")
+        _flatten_records(df_orders_raw["customer"], "customer_")
         if "customer" in df_orders_raw.columns
         else pd.DataFrame()
     )
 
     payment_df = (
-        pd.json_normalize(df_orders_raw["payment"]).add_prefix("payment_")
+        _flatten_records(df_orders_raw["payment"], "payment_")
         if "payment" in df_orders_raw.columns
         else pd.DataFrame()
     )
 
-    # Build FACT_ORDERS (one row per order)
+    # Build FACT_ORDERS (one row per order); customer_df/payment_df share df_orders_raw's index
     base_cols = [c for c in df_orders_raw.columns if c not in ("customer", "payment", "items")]
     df_fact_orders = pd.concat(
         [
-            df_orders_raw[base_cols].reset_index(drop=True),
-            customer_df.reset_index(drop=True),
-            payment_df.reset_index(drop=True),
+            df_orders_raw[base_cols],
+            customer_df,
+            payment_df,
         ],
         axis=1,
     )
@@ -148,69 +287,74 @@ def lambda_handler(event, context):
     # --- Explode items[] into FACT_ORDER_ITEMS ---
     if "items" in df_orders_raw.columns:
         ctx_cols = ["order_id", "order_timestamp", "order_date", "order_year", "order_month"]
-        df_items_ctx = df_orders_raw[ctx_cols + ["items"]].copy()
-
-        df_items_ctx = df_items_ctx.explode("items", ignore_index=True)
-
-        items_df = pd.json_normalize(df_items_ctx["items"])
-        df_fact_order_items = pd.concat(
-            [df_items_ctx.drop(columns=["items"]).reset_index(drop=True), items_df.reset_index(drop=True)],
-            axis=1,
-        )
+        # An empty/missing items value still yields one row with null item fields;
+        # a lone item object counts as a one-item list
+        items_lists = [
+            it if isinstance(it, list) and it else [it if isinstance(it, dict) else None]
+            for it in df_orders_raw["items"]
+        ]
+        n_items = np.fromiter((len(it) for it in items_lists), dtype=np.int64, count=len(items_lists))
+        total_items = int(n_items.sum())
+
+        # One preallocated column per item field; missing keys stay None
+        item_cols: dict[str, list] = {}
+        idx = 0
+        for items in items_lists:
+            for item in items:
+                if isinstance(item, dict):
+                    for k, v in item.items():
+                        col = item_cols.get(k)
+                        if col is None:
+                            col = item_cols[k] = [None] * total_items
+                        col[idx] = v
+                idx += 1
+
+        for k in ITEM_NUMERIC_COLS:
+            if k in item_cols:
+                item_cols[k] = _as_numeric(item_cols[k])
+
+        # Repeat each order's context once per item with a single positional take
+        df_items_ctx = df_orders_raw[ctx_cols].take(np.repeat(np.arange(len(n_items)), n_items))
+        df_items_ctx.index = pd.RangeIndex(total_items)
+
+        # copy=False keeps the numeric arrays as their own blocks
+        items_df = pd.DataFrame(item_cols, index=df_items_ctx.index, copy=False)
+        df_fact_order_items = pd.concat([df_items_ctx, items_df], axis=1)
+        del items_lists, item_cols, df_items_ctx, items_df
     else:
         df_fact_order_items = pd.DataFrame()
 
-    if not df_fact_order_items.empty:
-        if "quantity" in df_fact_order_items.columns:
-            df_fact_order_items["quantity"] = pd.to_numeric(df_fact_order_items["quantity"], errors="coerce")
-        if "unit_price" in df_fact_order_items.columns:
-            df_fact_order_items["unit_price"] = pd.to_numeric(df_fact_order_items["unit_price"], errors="coerce")
-        if "quantity" in df_fact_order_items.columns and "unit_price" in df_fact_order_items.columns:
-            df_fact_order_items["line_total"] = (
-                df_fact_order_items["quantity"] * df_fact_order_items["unit_price"]
-            ).round(2)
+    # Only the two fact tables are needed from here on
+    del df_orders_raw, customer_df, payment_df
+    gc.collect()
+
+    if "quantity" in df_fact_order_items.columns and "unit_price" in df_fact_order_items.columns:
+        # Multiplied in whole cents so totals are exact; stored in dollars because Athena/dbt read it as double
+        unit_price_cents = np.rint(df_fact_order_items["unit_price"].to_numpy(dtype=np.float64) * 100)
+        line_total_cents = np.rint(df_fact_order_items["quantity"].to_numpy(dtype=np.float64) * unit_price_cents)
+        df_fact_order_items["line_total"] = line_total_cents / 100
 
     # --- Write Parquet outputs partitioned by order_year/order_month ---
-    partitions = df_fact_orders[PARTITION_COLS].drop_duplicates().to_dict("records")
-
-    for p in partitions:
-        y = int(p["order_year"])
-        m = int(p["order_month"])
-
-        orders_part = df_fact_orders[(df_fact_orders["order_year"] == y) & (df_fact_orders["order_month"] == m)].copy()
-        items_part = (
-            df_fact_order_items[(df_fact_order_items["order_year"] == y) & (df_fact_order_items["order_month"] == m)].copy()
-            if not df_fact_order_items.empty
-            else pd.DataFrame()
-        )
-
-        # DROP partition cols from file schema to avoid Glue/Athena duplicate columns
-        orders_to_write = orders_part.drop(columns=PARTITION_COLS, errors="ignore")
-        items_to_write = items_part.drop(columns=PARTITION_COLS, errors="ignore")
-
-        run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S") + "-" + (context.aws_request_id if context else "local")
-
-        orders_key = (
-            f"{PROCESSED_PREFIX}/fact_orders/"
-            f"order_year={y}/order_month={m}/"
-            f"part-{run_id}.parquet"
-        )
-        items_key = (
-            f"{PROCESSED_PREFIX}/fact_order_items/"
-            f"order_year={y}/order_month={m}/"
-            f"part-{run_id}.parquet"
-        )
-
-        _write_parquet_and_upload(orders_to_write, out_bucket, orders_key)
-        _write_parquet_and_upload(items_to_write, out_bucket, items_key)
+    # Computed once per invocation and shared by both datasets and the response payload
+    run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S") + "-" + (context.aws_request_id if context else "local")
+    base_orders = f"{out_bucket}/{PROCESSED_PREFIX}/fact_orders"
+    base_items = f"{out_bucket}/{PROCESSED_PREFIX}/fact_order_items"
+
+    out_fs = _s3fs_for_bucket(out_bucket)
+    futures = [
+        _EXECUTOR.submit(_write_partitioned_dataset, df, out_fs, base_dir, run_id)
+        for df, base_dir in ((df_fact_orders, base_orders), (df_fact_order_items, base_items))
+    ]
+    for f in futures:
+        f.result()  # re-raise any write error
 
     return {
         "status": "ok",
         "input": f"s3://{in_bucket}/{in_key}",
         "output_bucket": out_bucket,
         "outputs": {
-            "fact_orders_prefix": f"s3://{out_bucket}/{PROCESSED_PREFIX}/fact_orders/",
-            "fact_order_items_prefix": f"s3://{out_bucket}/{PROCESSED_PREFIX}/fact_order_items/",
+            "fact_orders_prefix": f"s3://{base_orders}/",
+            "fact_order_items_prefix": f"s3://{base_items}/",
         },
         "rows": {
             "fact_orders": int(len(df_fact_orders)),